@@ -1,11 +1,23 @@
 import cv2
+import dlib
 import face_recognition
 import os
 import shutil
+import json
+import math
+import pickle
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
 import re
 import uuid
+import zipfile
 import numpy as np
+import numba
+from numba import njit, prange, types
 import time
+from datetime import datetime
 import gradio as gr # <-- Import Gradio
 from PIL import Image # <-- To handle image objects from Gradio
 
@@ -14,7 +26,49 @@ SOURCE_PHOTOS_DIR = "all_photos"
 USER_SELFIE_STORAGE_DIR = "user_selfies" # Gradio might save uploaded selfies here too
 OUTPUT_BASE_DIR = "sorted_user_photos"
 UNKNOWN_FACE_DIR_NAME = "unknown_user"
-ENCODINGS_FILE_PATH = "known_faces_encodings.npz"
+IMG_EXTS = ('.png', '.jpg', '.jpeg', '.bmp', '.tiff') # Lowercase extensions of event photos to scan
+COPY_MATCHES_TO_USER_FOLDER = True # Also keep a copy of each user's matches in OUTPUT_BASE_DIR/<phone number>/
+# Saved as <path>.json (current generation + scale) pointing at <path>.<generation>.npy (int8 matrix)
+# and <path>.<generation>.names.json (filenames); every save writes a new generation.
+ENCODINGS_FILE_PATH = "known_faces_encodings"
+ENCODING_CACHE_VERSION = 3 # Bump when the layout of <path>.cache.pkl changes
+# Burst shots: a new photo reuses another photo's encodings instead of being encoded when their 64-bit
+# perceptual hashes differ in at most PHASH_MAX_DISTANCE bits and they were taken at most
+# BURST_MAX_SECONDS apart (EXIF capture time, else file modification time). The time check keeps two
+# shots of the same backdrop (stage, photo booth) with different people in them from sharing faces.
+# Set FIND_MY_PHOTOS_DEDUPLICATE_BURSTS=0 to encode every photo.
+DEDUPLICATE_BURST_SHOTS = os.environ.get("FIND_MY_PHOTOS_DEDUPLICATE_BURSTS", "1") != "0"
+PHASH_MAX_DISTANCE = 5
+BURST_MAX_SECONDS = 3
+ENCODING_DIM = 128 # face_recognition/dlib encodings are 128-D vectors
+MATCH_TOLERANCE = 0.6 # Max euclidean distance between two encodings to count as the same person
+# Only the K closest known faces within MATCH_TOLERANCE are returned for a selfie; the status message
+# says so when a user hits the cap. Override with the FIND_MY_PHOTOS_MATCH_TOP_K environment variable.
+MATCH_TOP_K = int(os.environ.get("FIND_MY_PHOTOS_MATCH_TOP_K", "1000"))
+# Encoder settings shared by selfies and event photos (they must match for distances to be comparable).
+# Each extra jitter re-encodes the face with a random perturbation, multiplying encoder time for
+# a barely measurable gain. The 5-point "small" landmark model aligns the 150x150 chip faster than
+# the 68-point one. Neither setting changes the distance scale, so MATCH_TOLERANCE stays at 0.6.
+# Changing them (or SOURCE_MAX_IMAGE_SIDE / the source detector) invalidates the per-file cache,
+# so the next rescan re-encodes every photo (see _encoding_settings).
+ENCODING_NUM_JITTERS = 1
+ENCODING_LANDMARK_MODEL = "small"
+SOURCE_MAX_IMAGE_SIDE = 1000 # Event photos are shrunk to this long edge before face detection
+SELFIE_MAX_IMAGE_SIDE = 800 # Selfies are shrunk to this long edge before face detection
+# dlib's CNN face detector is only practical on a CUDA build of dlib (see ReadME.md). With one and a
+# visible GPU, event photos are detected in GPU batches and selfies with the CNN detector. A CUDA
+# build on a machine without a GPU stays on the CPU/HOG paths (the CNN detector would fail there).
+# Set FIND_MY_PHOTOS_USE_CUDA=0 to stay on the CPU/HOG paths even when dlib was built with CUDA.
+USE_CUDA = (os.environ.get("FIND_MY_PHOTOS_USE_CUDA", "1") != "0" and bool(dlib.DLIB_USE_CUDA)
+            and dlib.cuda.get_num_devices() > 0)
+SELFIE_DETECTION_MODEL = "cnn" if USE_CUDA else "hog"
+CUDA_BATCH_SIZE = 16 # Event photos per batched CNN detection call when dlib is built with CUDA
+# Rescans with fewer new/changed photos than this encode them in this process: each spawned pool
+# worker re-imports this script (gradio, dlib models), which costs more than encoding a few photos.
+ENCODE_IN_PROCESS_MAX_FILES = 8
+PREFETCH_WORKERS = 4 # Threads decoding event photos ahead of the GPU encoder
+PREFETCH_QUEUE_SIZE = 8 # Max decoded event photos waiting for the GPU encoder
+GRADIO_CONCURRENCY_LIMIT = 4 # Requests processed in parallel; they all share the loaded encodings
 
 # Ensure base directories exist (Gradio might run from a different working dir, ensure these are created)
 # It's good practice for these paths to be absolute or resolved at runtime if the script's location is variable.
@@ -23,9 +77,21 @@ os.makedirs(SOURCE_PHOTOS_DIR, exist_ok=True)
 os.makedirs(USER_SELFIE_STORAGE_DIR, exist_ok=True)
 os.makedirs(OUTPUT_BASE_DIR, exist_ok=True)
 
+# Known encodings shared read-only by all concurrent requests, as one (int8 matrix, scale, filenames)
+# tuple: loaded (memory-mapped) once and only replaced by a rescan. Requests read it without the lock;
+# because the tuple is rebound as a whole, they never see a matrix paired with another scan's
+# filenames, and they keep using the one they picked up. The lock only serializes loading/rescanning.
+KNOWN_ENCODINGS_LOCK = threading.Lock()
+KNOWN_ENCODINGS = None
+
+# Compiled once at import; these run on every request.
+_SANITIZE_BAD = re.compile(r'[^\w\s-]')
+_SANITIZE_SEP = re.compile(r'[-\s]+')
+_EMAIL_RE = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+
 def sanitize_foldername(name):
-    name = re.sub(r'[^\w\s-]', '', name).strip()
-    name = re.sub(r'[-\s]+', '-', name)
+    name = _SANITIZE_BAD.sub('', name).strip()
+    name = _SANITIZE_SEP.sub('-', name)
     return name if name else UNKNOWN_FACE_DIR_NAME
 
 def validate_phone_number(phone):
@@ -36,11 +102,154 @@ def validate_phone_number(phone):
 
 def validate_email_address(email):
     """Validates email address format."""
-    email_regex = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    if email and re.match(email_regex, email):
+    if email and _EMAIL_RE.match(email):
         return True, ""
     return False, "Invalid email format (e.g., user@example.com)."
 
+def _as_encoding_matrix(encodings):
+    """Stacks a list of encodings into one contiguous (N, 128) float32 matrix."""
+    if len(encodings) == 0:
+        return np.empty((0, ENCODING_DIM), dtype=np.float32)
+    return np.ascontiguousarray(np.stack(encodings), dtype=np.float32)
+
+def _quantization_scale(encodings):
+    """Global scale that maps the largest absolute encoding value onto 127."""
+    max_abs = float(np.abs(encodings).max()) if len(encodings) else 0.0
+    # dlib's encoding values reach well beyond 0.05 in practice; the floor only bounds the scale
+    # (and so the integer tolerance) for degenerate sets, keeping _topk_rows' int32 sums from overflowing.
+    return 127.0 / max(max_abs, 0.05)
+
+def _quantize(encodings, scale):
+    """Quantizes a float encoding matrix to int8 with the given scale."""
+    return np.ascontiguousarray(np.clip(np.rint(np.asarray(encodings, dtype=np.float32) * scale), -127, 127), dtype=np.int8)
+
+# Squared euclidean distance of known encodings start..stop to the selfie, keeping the k closest ones
+# within tolerance in a fixed-size max-heap (root = farthest kept face), so a single pass over the
+# rows both filters and ranks. Fills heap_dist/heap_idx (length k) and returns how many were kept.
+# Encodings are stored as int8, so the pass streams a quarter of the bytes float32 would. The selfie
+# is int16 so it is not clipped to the known set's range (see find_matching_photos); the differences
+# are widened to int32, which cannot overflow (128 * (254 + tolerance)**2 < 2**31, see
+# _quantization_scale).
+@njit(fastmath=True, cache=True, nogil=True)
+def _topk_rows(known_matrix, selfie, tolerance_sq, start, stop, heap_dist, heap_idx):
+    k = heap_dist.shape[0]
+    size = 0
+    for i in range(start, stop if k > 0 else start):
+        acc = np.int32(0)
+        for j in range(known_matrix.shape[1]):
+            d = np.int32(known_matrix[i, j]) - np.int32(selfie[j])
+            acc += d * d
+        if acc >= tolerance_sq:
+            continue
+        if size < k:
+            # Heap not full yet: append and sift up.
+            pos = size
+            size += 1
+            while pos > 0:
+                parent = (pos - 1) // 2
+                if heap_dist[parent] >= acc:
+                    break
+                heap_dist[pos] = heap_dist[parent]
+                heap_idx[pos] = heap_idx[parent]
+                pos = parent
+        elif acc < heap_dist[0]:
+            # Closer than the farthest kept face: replace the root and sift down.
+            pos = 0
+            while True:
+                child = 2 * pos + 1
+                if child >= size:
+                    break
+                if child + 1 < size and heap_dist[child + 1] > heap_dist[child]:
+                    child += 1
+                if heap_dist[child] <= acc:
+                    break
+                heap_dist[pos] = heap_dist[child]
+                heap_idx[pos] = heap_idx[child]
+                pos = child
+        else:
+            continue
+        heap_dist[pos] = acc
+        heap_idx[pos] = i
+    return size
+
+# The k closest known encodings within tolerance, as (row indices, squared distances), closest first.
+# The rows are split into up to max_chunks chunks (one per Numba thread) under prange, each with its
+# own _topk_rows heap, and the few per-chunk results are merged at the end, so a query uses every core.
+# Chunks are at least 1024 rows so small collections do not pay for threads (or k-sized heaps) they
+# cannot use.
+# cache=True writes the compiled kernel to __pycache__ so only the very first run pays the compile.
+# The inputs are typed read-only so the memory-mapped matrix from load_known_encodings is accepted as is.
+# nogil lets concurrent Gradio requests scan the shared matrix at the same time (see _run_topk).
+@njit(types.Tuple((types.int64[::1], types.int32[::1]))(types.Array(types.int8, 2, 'C', readonly=True),
+                                                        types.Array(types.int16, 1, 'C', readonly=True),
+                                                        types.int32, types.int64, types.int64),
+      parallel=True, fastmath=True, cache=True, nogil=True)
+def _topk(known_matrix, selfie, tolerance_sq, k, max_chunks):
+    n = known_matrix.shape[0]
+    k = max(k, 0)
+    chunks = max(1, min(max_chunks, n // 1024))
+    heap_dist = np.empty((chunks, k), dtype=np.int32)
+    heap_idx = np.empty((chunks, k), dtype=np.int64)
+    sizes = np.empty(chunks, dtype=np.int64)
+    for c in prange(chunks):
+        sizes[c] = _topk_rows(known_matrix, selfie, tolerance_sq, n * c // chunks, n * (c + 1) // chunks,
+                              heap_dist[c], heap_idx[c])
+    merged_dist = np.empty(sizes.sum(), dtype=np.int32)
+    merged_idx = np.empty(sizes.sum(), dtype=np.int64)
+    pos = 0
+    for c in range(chunks):
+        merged_dist[pos:pos + sizes[c]] = heap_dist[c, :sizes[c]]
+        merged_idx[pos:pos + sizes[c]] = heap_idx[c, :sizes[c]]
+        pos += sizes[c]
+    order = np.argsort(merged_dist, kind='mergesort')[:k]
+    return merged_idx[order], merged_dist[order]
+
+# Numba's fallback 'workqueue' threading layer (used when neither TBB nor OpenMP is available) aborts
+# the process if two threads launch parallel kernels at once; only then do requests take turns.
+_TOPK_LOCK = threading.Lock()
+
+def _run_topk(known_matrix, selfie, tolerance_sq, k):
+    # The thread count is read here rather than in the kernel, which would make it uncacheable.
+    max_chunks = numba.get_num_threads()
+    try:
+        serialize = numba.threading_layer() == "workqueue"
+    except ValueError: # No parallel kernel has run yet, so no layer has been chosen
+        serialize = True
+    if serialize:
+        with _TOPK_LOCK:
+            return _topk(known_matrix, selfie, tolerance_sq, k, max_chunks)
+    return _topk(known_matrix, selfie, tolerance_sq, k, max_chunks)
+
+def _downscale(image, max_side):
+    """
+    Shrinks an RGB image so its long edge is at most max_side pixels.
+    The encoder only ever sees a 150x150 face chip, so full-resolution input
+    just makes the HOG detector scan a much bigger image pyramid.
+    """
+    h, w = image.shape[:2]
+    scale = max_side / max(h, w)
+    if scale < 1.0:
+        image = cv2.resize(image, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+    return image
+
+def _imread(image_path, flags):
+    """
+    cv2.imread replacement: Python reads the bytes and OpenCV only decodes them, because
+    cv2.imread cannot open non-ASCII paths on Windows.
+    """
+    data = np.fromfile(image_path, dtype=np.uint8)
+    image = cv2.imdecode(data, flags) if data.size > 0 else None
+    if image is None:
+        raise ValueError(f"could not read image file '{image_path}'")
+    return image
+
+def _load_rgb(image_path):
+    """
+    Decodes an image file to a uint8 HxWx3 RGB array, the same format
+    face_recognition.load_image_file returns, but through OpenCV (libjpeg-turbo).
+    """
+    return cv2.cvtColor(_imread(image_path, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+
 def load_and_encode_face(image_input, is_path=True):
     """
     Loads an image from a path or uses a PIL Image object,
@@ -49,23 +258,345 @@ def load_and_encode_face(image_input, is_path=True):
     try:
         if is_path:
             # print(f"Loading and encoding face from path: {image_input}") # Console log
-            image = face_recognition.load_image_file(image_input)
+            image = _load_rgb(image_input)
         else: # image_input is a PIL Image object
             # print(f"Encoding face from PIL Image object.") # Console log
-            image = np.array(image_input.convert('RGB')) # Ensure RGB
+            # Webcam/upload images are normally RGB already; only convert other modes (RGBA, L, ...)
+            # and use asarray to avoid the extra copy np.array would make.
+            if image_input.mode != 'RGB':
+                image_input = image_input.convert('RGB')
+            image = np.asarray(image_input)
+        image = _downscale(image, SELFIE_MAX_IMAGE_SIDE)
 
-        face_encodings_list = face_recognition.face_encodings(image)
-
-        if face_encodings_list:
-            return face_encodings_list[0]
-        else:
+        face_locations = face_recognition.face_locations(image, model=SELFIE_DETECTION_MODEL)
+        if not face_locations:
             print(f"Warning: No faces found in the provided selfie.")
             return None
+        face_encodings_list = face_recognition.face_encodings(image, known_face_locations=face_locations[:1], num_jitters=ENCODING_NUM_JITTERS, model=ENCODING_LANDMARK_MODEL)
+        return face_encodings_list[0]
     except Exception as e:
         print(f"Error processing selfie image: {e}")
         return None
 
+def _load_source_image(image_path):
+    return _downscale(_load_rgb(image_path), SOURCE_MAX_IMAGE_SIDE)
+
+def _encode_one(image_path):
+    """
+    Pool worker: loads one source photo and returns (filename, encodings).
+    encodings is None if the file could not be processed.
+    """
+    filename = os.path.basename(image_path)
+    try:
+        image = _load_source_image(image_path)
+        # Cheap HOG pass first: photos without faces (scenery, decor) never reach the ResNet encoder.
+        face_locations = face_recognition.face_locations(image, model="hog")
+        if not face_locations:
+            return filename, []
+        return filename, face_recognition.face_encodings(image, known_face_locations=face_locations, num_jitters=ENCODING_NUM_JITTERS, model=ENCODING_LANDMARK_MODEL)
+    except Exception as e:
+        print(f"    Error processing {filename} for encoding: {e}. Skipping.")
+        return filename, None
+
+def _prefetch_source_images(image_paths):
+    """
+    Yields (filename, image) in order while PREFETCH_WORKERS threads decode the photos
+    that follow; image is None if the file could not be loaded. JPEG decoding and the
+    resize release the GIL, so they overlap with dlib running in the caller, and at most
+    PREFETCH_QUEUE_SIZE decoded photos wait in memory.
+    """
+    pending = queue.Queue(maxsize=PREFETCH_QUEUE_SIZE)
+    stop = threading.Event()
+
+    def put(item):
+        # Gives up once the consumer is gone instead of blocking on a full queue forever.
+        while not stop.is_set():
+            try:
+                pending.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        for image_path in image_paths:
+            if not put((os.path.basename(image_path), executor.submit(_load_source_image, image_path))):
+                return
+        put(None)
+
+    with ThreadPoolExecutor(max_workers=PREFETCH_WORKERS) as executor:
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            while (item := pending.get()) is not None:
+                filename, future = item
+                try:
+                    yield filename, future.result()
+                except Exception as e:
+                    print(f"    Error processing {filename} for encoding: {e}. Skipping.")
+                    yield filename, None
+        finally:
+            # The caller may stop early (generator closed, exception): stop the producer and drop
+            # the photos nobody will consume, cancelling the decodes that have not started yet.
+            stop.set()
+            producer.join()
+            while True:
+                try:
+                    item = pending.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None:
+                    item[1].cancel()
+
+def _detect_faces_single(filename, image):
+    """
+    Per-photo fallback for a batch the CNN detector failed on (e.g. out of GPU memory):
+    tries the CNN detector on this photo alone, then HOG. Returns None if both fail.
+    """
+    for model in ("cnn", "hog"):
+        try:
+            return face_recognition.face_locations(image, model=model)
+        except Exception as e:
+            print(f"    Error running '{model}' face detection on {filename}: {e}.")
+    return None
+
+def _encode_cuda_batch(filenames, images):
+    """
+    Runs dlib's CNN detector once for the whole batch to amortize the host-to-device
+    copies, then encodes each photo at the detected locations.
+    """
+    # The batched detector needs every image to have the same shape. Zero-padding on the
+    # bottom/right keeps the detected coordinates valid for the original pixels.
+    height = max(image.shape[0] for image in images)
+    width = max(image.shape[1] for image in images)
+    padded_images = [cv2.copyMakeBorder(image, 0, height - image.shape[0], 0, width - image.shape[1],
+                                        cv2.BORDER_CONSTANT, value=0) for image in images]
+    try:
+        batch_locations = face_recognition.batch_face_locations(padded_images, batch_size=CUDA_BATCH_SIZE)
+    except Exception as e:
+        # Skipped photos are not cached, so failing the whole batch would hit the same error on
+        # every rescan and those photos could never be indexed; detect them one by one instead.
+        print(f"    Error running batched face detection: {e}. Detecting {len(filenames)} files one by one.")
+        batch_locations = [_detect_faces_single(filename, image) for filename, image in zip(filenames, images)]
+
+    for filename, image, face_locations in zip(filenames, images, batch_locations):
+        if face_locations is None:
+            print(f"    Skipping {filename}: face detection failed.")
+            yield filename, None
+            continue
+        if not face_locations:
+            yield filename, []
+            continue
+        try:
+            yield filename, face_recognition.face_encodings(image, known_face_locations=face_locations, num_jitters=ENCODING_NUM_JITTERS, model=ENCODING_LANDMARK_MODEL)
+        except Exception as e:
+            print(f"    Error processing {filename} for encoding: {e}. Skipping.")
+            yield filename, None
+
+def _encode_batch_cuda(image_paths):
+    """
+    GPU counterpart of _encode_one, used when dlib is built with CUDA.
+    Photos are decoded by _prefetch_source_images while the GPU works on the previous
+    batch. Yields the same (filename, encodings) pairs as _encode_one.
+    """
+    filenames = []
+    images = []
+    for filename, image in _prefetch_source_images(image_paths):
+        if image is None:
+            yield filename, None
+            continue
+        filenames.append(filename)
+        images.append(image)
+        if len(images) == CUDA_BATCH_SIZE:
+            yield from _encode_cuda_batch(filenames, images)
+            filenames = []
+            images = []
+    if images:
+        yield from _encode_cuda_batch(filenames, images)
+
+def _iter_source_encodings(image_paths):
+    """Yields (filename, encodings) for every path (a list), on the GPU if available, else on all CPU cores."""
+    if USE_CUDA:
+        # Keep CUDA in this process; the batches already keep the GPU busy.
+        yield from _encode_batch_cuda(image_paths)
+        return
+    if len(image_paths) < ENCODE_IN_PROCESS_MAX_FILES:
+        for image_path in image_paths:
+            yield _encode_one(image_path)
+        return
+    # dlib releases the GIL but face_encodings is CPU bound, so spread the files over all cores.
+    # 'spawn' keeps this working the same way on Windows, macOS and Linux.
+    with multiprocessing.get_context("spawn").Pool(processes=min(os.cpu_count(), len(image_paths))) as pool:
+        yield from pool.imap_unordered(_encode_one, image_paths, chunksize=4)
+
+def _read_encodings_pointer(encodings_file_path):
+    """Returns (generation, scale) from <path>.json."""
+    with open(encodings_file_path + ".json", encoding="utf-8") as f:
+        pointer = json.load(f)
+    return int(pointer["generation"]), float(pointer["scale"])
+
+def _remove_old_encoding_generations(encodings_file_path, current_generation):
+    """
+    Deletes the .npy/.names.json files of every other generation. A file that is still memory-mapped
+    by a request (or by the previous shared matrix) cannot be deleted on Windows; it is left
+    for a later save, by which time nothing maps it any more.
+    """
+    directory = os.path.dirname(encodings_file_path) or "."
+    generation_file = re.compile(re.escape(os.path.basename(encodings_file_path)) + r'\.(\d+)\.(npy|names\.json)$')
+    for filename in os.listdir(directory):
+        match = generation_file.match(filename)
+        if match and int(match.group(1)) != current_generation:
+            try:
+                os.remove(os.path.join(directory, filename))
+            except OSError:
+                pass
+
+def _save_known_encodings(encodings_file_path, encodings, filenames):
+    """
+    Quantizes the encodings to int8 with one global scale and writes them as a raw (N, 128)
+    <path>.<generation>.npy plus the matching filenames to <path>.<generation>.names.json
+    (a JSON list), then points <path>.json (generation + scale) at them. Returns the quantized
+    matrix and its scale.
+    """
+    encodings = _as_encoding_matrix(encodings)
+    scale = _quantization_scale(encodings)
+    quantized = _quantize(encodings, scale)
+    # Always write a new generation instead of overwriting or renaming over the current files:
+    # the loaded matrix memory-maps them, and Windows refuses to replace a mapped file. Only the
+    # small, never-mapped pointer file is swapped, atomically, once the new data is complete.
+    try:
+        generation = _read_encodings_pointer(encodings_file_path)[0] + 1
+    except Exception:
+        generation = 1
+    # A JSON list rather than one name per line: filenames may legally contain newlines and other
+    # line separators, which would shift every name after them. The default ensure_ascii escaping
+    # also round-trips names that are not valid UTF-8 (surrogate-escaped by os.scandir).
+    with open(f"{encodings_file_path}.{generation}.names.json", "w", encoding="utf-8") as f:
+        json.dump(list(filenames), f)
+    with open(f"{encodings_file_path}.{generation}.npy", "wb") as f:
+        np.save(f, quantized)
+    with open(encodings_file_path + ".json.tmp", "w", encoding="utf-8") as f:
+        json.dump({"generation": generation, "scale": scale}, f)
+    os.replace(encodings_file_path + ".json.tmp", encodings_file_path + ".json")
+    _remove_old_encoding_generations(encodings_file_path, generation)
+    return quantized, scale
+
+def _iter_source_image_entries(source_dir):
+    """Yields an os.DirEntry per image file in source_dir (stat info comes with the directory listing)."""
+    with os.scandir(source_dir) as it:
+        for entry in it:
+            if entry.is_file() and entry.name.lower().endswith(IMG_EXTS):
+                yield entry
+
+def _phash(image_path):
+    """
+    64-bit perceptual hash: the low-frequency 8x8 DCT block of a 32x32 grayscale
+    thumbnail, thresholded at its median. Burst shots of the same scene land within
+    a few bits of each other. JPEGs are decoded at 1/4 scale, which is much cheaper.
+    """
+    gray = _imread(image_path, cv2.IMREAD_REDUCED_GRAYSCALE_4)
+    thumbnail = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low_frequencies = cv2.dct(thumbnail)[:8, :8].flatten()
+    bits = low_frequencies > np.median(low_frequencies)
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def _capture_time(image_path):
+    """
+    Returns ("exif", seconds) from the EXIF DateTimeOriginal (or DateTime) tag, else ("mtime", seconds)
+    from the file. Only times of the same kind are compared: EXIF times carry no timezone.
+    """
+    try:
+        with Image.open(image_path) as image: # Reads the header only, not the pixels
+            exif = image.getexif()
+            taken = exif.get_ifd(0x8769).get(36867) or exif.get(306)
+        if taken:
+            return "exif", datetime.strptime(taken.strip("\x00 "), "%Y:%m:%d %H:%M:%S").timestamp()
+    except Exception:
+        pass
+    return "mtime", os.path.getmtime(image_path)
+
+def _burst_signature_or_none(image_path):
+    """Returns (filename, phash, capture time); both are None if the file could not be read."""
+    try:
+        return os.path.basename(image_path), _phash(image_path), _capture_time(image_path)
+    except Exception:
+        return os.path.basename(image_path), None, None # The encoder will report the unreadable file
+
+def _phash_band_keys(phash):
+    """
+    Splits a hash into PHASH_MAX_DISTANCE + 1 bands. Two hashes within PHASH_MAX_DISTANCE
+    bits must agree exactly on at least one band, so indexing by band finds every
+    near-duplicate candidate without comparing against all previous photos.
+    """
+    bands = PHASH_MAX_DISTANCE + 1
+    keys = []
+    shift = 0
+    for band in range(bands):
+        width = 64 // bands + (1 if band < 64 % bands else 0)
+        keys.append((band, (phash >> shift) & ((1 << width) - 1)))
+        shift += width
+    return keys
+
+def _find_near_duplicate(phash_index, phashes, capture_times, phash, capture_time):
+    """
+    Returns the filename of an indexed photo within PHASH_MAX_DISTANCE bits of phash that was taken
+    at most BURST_MAX_SECONDS from capture_time, or None.
+    """
+    for key in _phash_band_keys(phash):
+        for filename in phash_index.get(key, ()):
+            other_time = capture_times[filename]
+            if (bin(phash ^ phashes[filename]).count("1") <= PHASH_MAX_DISTANCE
+                    and other_time[0] == capture_time[0] and abs(other_time[1] - capture_time[1]) <= BURST_MAX_SECONDS):
+                return filename
+    return None
+
+def _add_to_phash_index(phash_index, filename, phash):
+    for key in _phash_band_keys(phash):
+        phash_index.setdefault(key, []).append(filename)
+
+def _encoding_settings():
+    """Every setting that changes the stored source-photo encodings; cached encodings are only reused if it matches."""
+    return {
+        "source_max_image_side": SOURCE_MAX_IMAGE_SIDE,
+        "num_jitters": ENCODING_NUM_JITTERS,
+        "landmark_model": ENCODING_LANDMARK_MODEL,
+        "source_detection_model": "cnn" if USE_CUDA else "hog",
+        # Photos deduplicated under other rules hold encodings copied from another photo.
+        "burst_dedup": (PHASH_MAX_DISTANCE, BURST_MAX_SECONDS) if DEDUPLICATE_BURST_SHOTS else None,
+    }
+
+def _load_encoding_cache(encodings_file_path):
+    """
+    Returns the per-file cache {filename: (mtime_ns, size, float32 encodings, phash, capture time)} written by the
+    last scan, or an empty dict if there is none (or it is unreadable / from an older layout /
+    made with different encoding settings).
+    """
+    try:
+        with open(encodings_file_path + ".cache.pkl", "rb") as f:
+            cache = pickle.load(f)
+        if cache.get("version") == ENCODING_CACHE_VERSION:
+            if cache.get("settings") == _encoding_settings():
+                return cache["files"]
+            print("Encoding settings changed since the last scan; re-encoding all photos.") # Console log
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"Ignoring unreadable encoding cache: {e}") # Console log
+    return {}
+
+def _save_encoding_cache(encodings_file_path, files):
+    with open(encodings_file_path + ".cache.pkl", "wb") as f:
+        pickle.dump({"version": ENCODING_CACHE_VERSION, "settings": _encoding_settings(), "files": files},
+                    f, protocol=pickle.HIGHEST_PROTOCOL)
+
 def generate_and_save_known_encodings(source_dir, encodings_file_path):
+    """
+    Scans source_dir and (re)builds the encodings file. Only photos that are new or whose
+    (mtime, size) changed since the last scan are encoded; everything else comes from the
+    per-file cache, and photos that were removed from source_dir are dropped. New photos that
+    are burst shots of another photo (near-duplicate perceptual hash, taken seconds apart) reuse
+    that photo's encodings unless DEDUPLICATE_BURST_SHOTS is off.
+    """
     # print(f"Generating and saving new encodings from {source_dir} to {encodings_file_path}...") # Console log
     known_encodings = []
     known_filenames = []
@@ -76,83 +607,159 @@ def generate_and_save_known_encodings(source_dir, encodings_file_path):
     # Progress tracking for Gradio (optional, more advanced for real-time updates)
     # For now, we'll just return a summary message.
 
-    for filename in os.listdir(source_dir):
-        if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.tiff')):
-            image_path = os.path.join(source_dir, filename)
-            try:
-                image = face_recognition.load_image_file(image_path)
-                current_image_encodings = face_recognition.face_encodings(image)
-                
-                for encoding in current_image_encodings:
-                    known_encodings.append(encoding)
-                    known_filenames.append(filename) 
-                
-                # if not current_image_encodings:
-                    # print(f"    No faces found in {filename}.") # Console log
-                files_processed += 1
-            except Exception as e:
-                print(f"    Error processing {filename} for encoding: {e}. Skipping.")
-                skipped_files +=1
+    cached_files = _load_encoding_cache(encodings_file_path)
+    current_files = {}
+    stat_keys = {}
+    image_paths = []
+    for entry in _iter_source_image_entries(source_dir):
+        stat = entry.stat()
+        stat_key = (stat.st_mtime_ns, stat.st_size)
+        cached = cached_files.get(entry.name)
+        if cached is not None and cached[:2] == stat_key:
+            current_files[entry.name] = cached
+        else:
+            stat_keys[entry.name] = stat_key
+            image_paths.append(entry.path)
+    reused_files = len(current_files)
+    removed_files = len(cached_files.keys() - current_files.keys() - stat_keys.keys())
+
+    # Burst shots: hash the new photos (cheap, reduced-size decode) and only encode one photo per
+    # burst, matching against both cached photos and earlier new ones.
+    phashes = {}
+    capture_times = {}
+    if DEDUPLICATE_BURST_SHOTS:
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            for filename, phash, capture_time in executor.map(_burst_signature_or_none, image_paths):
+                if phash is not None:
+                    phashes[filename] = phash
+                    capture_times[filename] = capture_time
+    phash_index = {}
+    for filename, cached in current_files.items():
+        if cached[3] is not None:
+            phashes[filename] = cached[3]
+            capture_times[filename] = cached[4]
+            _add_to_phash_index(phash_index, filename, cached[3])
+    paths_to_encode = []
+    duplicate_of = {}
+    for image_path in sorted(image_paths):
+        filename = os.path.basename(image_path)
+        phash = phashes.get(filename)
+        original = (_find_near_duplicate(phash_index, phashes, capture_times, phash, capture_times[filename])
+                    if phash is not None else None)
+        if original is not None:
+            duplicate_of[filename] = original
+        else:
+            paths_to_encode.append(image_path)
+            if phash is not None:
+                _add_to_phash_index(phash_index, filename, phash)
+
+    for filename, current_image_encodings in _iter_source_encodings(paths_to_encode):
+        if current_image_encodings is None:
+            skipped_files += 1 # Not cached, so it is retried on the next scan
+            continue
+        current_files[filename] = (*stat_keys[filename], _as_encoding_matrix(current_image_encodings),
+                                   phashes.get(filename), capture_times.get(filename))
+        files_processed += 1
+    duplicate_files = 0
+    for filename, original in duplicate_of.items():
+        if original not in current_files:
+            skipped_files += 1 # Its original failed to encode; retried on the next scan
+            continue
+        current_files[filename] = (*stat_keys[filename], current_files[original][2], phashes[filename], capture_times[filename])
+        duplicate_files += 1
+    _save_encoding_cache(encodings_file_path, current_files)
+
+    for filename in sorted(current_files):
+        for encoding in current_files[filename][2]:
+            known_encodings.append(encoding)
+            known_filenames.append(filename)
     
     if known_encodings:
-        np.savez_compressed(encodings_file_path, encodings=np.array(known_encodings), filenames=np.array(known_filenames))
+        known_encodings, known_scale = _save_known_encodings(encodings_file_path, known_encodings, known_filenames)
         end_time = time.time()
-        msg = (f"Encoding Generation Complete: Successfully generated {len(known_encodings)} face encodings "
-               f"from {files_processed} images ({skipped_files} skipped) in {end_time - start_time:.2f} seconds. "
-               f"Encodings saved to {os.path.basename(encodings_file_path)}.")
+        msg = (f"Encoding Generation Complete: {len(known_encodings)} face encodings available. "
+               f"Encoded {files_processed} new or changed images ({skipped_files} skipped), copied encodings to "
+               f"{duplicate_files} near-duplicate images, reused {reused_files} "
+               f"unchanged images and dropped {removed_files} removed ones in {end_time - start_time:.2f} seconds. "
+               f"Encodings saved to {os.path.basename(encodings_file_path)}.json.")
         print(msg) # Console log
-        return known_encodings, known_filenames, msg
+        return known_encodings, known_scale, known_filenames, msg
     else:
         msg = "Encoding Generation: No encodings were generated. Source directory might be empty, no faces found, or all files had errors."
         print(msg) # Console log
         # Save an empty file to avoid re-scanning empty/problematic dirs constantly if file didn't exist
-        np.savez_compressed(encodings_file_path, encodings=np.array([]), filenames=np.array([]))
-        return [], [], msg
+        known_encodings, known_scale = _save_known_encodings(encodings_file_path, [], [])
+        return known_encodings, known_scale, [], msg
+
+def _load_once():
+    """Loads the encodings file into the shared KNOWN_ENCODINGS. Call with KNOWN_ENCODINGS_LOCK held."""
+    global KNOWN_ENCODINGS
+    encodings, scale, filenames, msg = load_known_encodings(ENCODINGS_FILE_PATH)
+    KNOWN_ENCODINGS = (encodings, scale, filenames) if encodings is not None else None
+    return msg
 
 def load_known_encodings(encodings_file_path):
     try:
-        data = np.load(encodings_file_path, allow_pickle=True) 
-        if data['encodings'].size == 0 and data['filenames'].size == 0 :
-             msg = f"Loaded encoding file '{os.path.basename(encodings_file_path)}' is empty (no faces previously found or empty source dir)."
+        # Memory-mapped and read-only: no decompress or copy, pages are faulted in on first use.
+        generation, scale = _read_encodings_pointer(encodings_file_path)
+        encodings = np.load(f"{encodings_file_path}.{generation}.npy", mmap_mode='r')
+        with open(f"{encodings_file_path}.{generation}.names.json", encoding="utf-8") as f:
+            filenames = json.load(f)
+        if encodings.dtype != np.int8 or encodings.ndim != 2 or encodings.shape[1] != ENCODING_DIM:
+            raise ValueError(f"unexpected encodings array {encodings.dtype}{encodings.shape}")
+        if len(filenames) != len(encodings):
+            raise ValueError(f"{len(encodings)} encodings but {len(filenames)} filenames")
+        if len(encodings) == 0:
+             msg = f"Loaded encoding file '{os.path.basename(encodings_file_path)}.json' is empty (no faces previously found or empty source dir)."
              # print(msg) # Console log
-             return [],[], msg
-        encodings = list(data['encodings']) if data['encodings'].size > 0 else []
-        filenames = list(data['filenames']) if data['filenames'].size > 0 else []
-        msg = f"Successfully loaded {len(encodings)} known face encodings from {os.path.basename(encodings_file_path)}."
+             return encodings, scale, [], msg
+        msg = f"Successfully loaded {len(encodings)} known face encodings from {os.path.basename(encodings_file_path)}.json."
         # print(msg) # Console log
-        return encodings, filenames, msg
+        return encodings, scale, filenames, msg
     except FileNotFoundError:
-        msg = f"Encodings file '{os.path.basename(encodings_file_path)}' not found. Will proceed to generate if 'Force Rescan' is chosen or if it's the first run."
+        msg = f"Encodings file '{os.path.basename(encodings_file_path)}.json' not found. Will proceed to generate if 'Force Rescan' is chosen or if it's the first run."
         # print(msg) # Console log
-        return None, None, msg
+        return None, None, None, msg
     except Exception as e:
-        msg = f"Error loading encodings from {os.path.basename(encodings_file_path)}: {e}. Will proceed to generate if 'Force Rescan' is chosen."
+        msg = f"Error loading encodings from {os.path.basename(encodings_file_path)}.json: {e}. Will proceed to generate if 'Force Rescan' is chosen."
         print(f"Error loading encodings: {e}") # Console log
-        return None, None, msg
+        return None, None, None, msg
 
-def find_matching_photos(selfie_encoding, all_known_encodings, all_known_filenames, source_image_dir):
-    if selfie_encoding is None or not all_known_encodings:
-        return []
-    matched_photo_filenames = set() 
+def find_matching_photos(selfie_encoding, all_known_encodings, encodings_scale, all_known_filenames, source_image_dir):
+    """
+    Returns (matched_photo_paths, match_distances, results_limited), closest match first.
+    Only the MATCH_TOP_K closest known faces within MATCH_TOLERANCE are considered;
+    results_limited is True when that cap was reached, so more matches may exist.
+    """
+    if selfie_encoding is None or len(all_known_encodings) == 0:
+        return [], [], False
     # print(f"\nComparing selfie with {len(all_known_encodings)} known faces...") # Console log
     start_time = time.time()
-    # Ensure all_known_encodings is a list of numpy arrays
-    # np.savez_compressed already saves them as numpy arrays, and list() conversion is fine.
-    matches_array = face_recognition.compare_faces(all_known_encodings, selfie_encoding, tolerance=0.6)
-    for i, match in enumerate(matches_array):
-        if match:
-            matched_photo_filenames.add(all_known_filenames[i])
+    # all_known_encodings is a contiguous (N, 128) int8 matrix quantized with encodings_scale.
+    # The selfie is quantized with the same scale and the tolerance moves into the same integer units;
+    # comparing squared distances against tolerance**2 avoids the sqrt entirely.
+    # The selfie may exceed the known set's range, so it is not clipped to int8 (that would shrink
+    # its distances and create false matches). It is only clipped at 127 + tolerance: a value beyond
+    # that is farther than the tolerance from every known value, before and after clipping.
+    tolerance = MATCH_TOLERANCE * encodings_scale
+    selfie_limit = 127 + math.ceil(tolerance)
+    selfie = np.ascontiguousarray(np.clip(np.rint(np.asarray(selfie_encoding, dtype=np.float32) * encodings_scale),
+                                          -selfie_limit, selfie_limit), dtype=np.int16)
+    tolerance_sq = np.int32(math.ceil(tolerance ** 2))
+    match_indices, match_distances_sq = _run_topk(all_known_encodings, selfie, tolerance_sq, MATCH_TOP_K)
+    # A photo can hold several matching faces; keep each filename once, at its closest distance.
+    matched_photo_filenames = {}
+    for i, distance_sq in zip(match_indices, match_distances_sq):
+        matched_photo_filenames.setdefault(all_known_filenames[i], math.sqrt(distance_sq) / encodings_scale)
     end_time = time.time()
     # print(f"Comparison completed in {end_time - start_time:.2f} seconds.") # Console log
     matched_photo_paths = [os.path.join(source_image_dir, fname) for fname in matched_photo_filenames]
-    return matched_photo_paths
+    results_limited = len(match_indices) == MATCH_TOP_K
+    return matched_photo_paths, list(matched_photo_filenames.values()), results_limited
 
 def create_user_folder_and_copy_photos(user_identifier, matched_photos, base_output_dir):
     user_folder_name = sanitize_foldername(user_identifier)
     user_specific_dir = os.path.join(base_output_dir, user_folder_name)
-    # Ensure the user-specific directory is clean if it already exists, or handle as needed
-    if os.path.exists(user_specific_dir):
-        shutil.rmtree(user_specific_dir) # Remove old results for this user for this session
     os.makedirs(user_specific_dir, exist_ok=True)
     
     copied_files_paths = []
@@ -160,23 +767,73 @@ def create_user_folder_and_copy_photos(user_identifier, matched_photos, base_out
     if not matched_photos: # Ensure matched_photos is not None
         matched_photos = []
 
+    # Sync the folder with this request's matches instead of wiping and re-copying it (returning
+    # users usually get the same matches): photos already there with the same name and size are
+    # kept, photos that are no longer matches are removed and only missing ones are copied.
+    wanted_photos = {}
     for photo_path in matched_photos:
         try:
-            filename = os.path.basename(photo_path)
-            destination_path = os.path.join(user_specific_dir, filename)
+            wanted_photos[os.path.basename(photo_path)] = (photo_path, os.path.getsize(photo_path))
+        except OSError as e:
+            print(f"  Error copying {os.path.basename(photo_path)}: {e}") # Console log
+    with os.scandir(user_specific_dir) as it:
+        existing_sizes = {entry.name: entry.stat().st_size for entry in it if entry.is_file()}
+
+    removed_count = 0
+    for filename in existing_sizes.keys() - wanted_photos.keys():
+        try:
+            os.remove(os.path.join(user_specific_dir, filename))
+            removed_count += 1
+        except OSError as e:
+            print(f"  Error removing old result {filename}: {e}") # Console log
+
+    kept_count = 0
+    for filename, (photo_path, size) in wanted_photos.items():
+        destination_path = os.path.join(user_specific_dir, filename)
+        if existing_sizes.get(filename) == size:
+            copied_files_paths.append(destination_path)
+            kept_count += 1
+            continue
+        try:
             shutil.copy(photo_path, destination_path)
             copied_files_paths.append(destination_path) 
             copied_count += 1
         except Exception as e:
-            print(f"  Error copying {os.path.basename(photo_path)}: {e}") # Console log
+            print(f"  Error copying {filename}: {e}") # Console log
     
-    if copied_count > 0:
-        msg = f"Successfully copied {copied_count} matched photos to folder: '{user_folder_name}'"
+    if copied_files_paths:
+        msg = (f"Successfully synced {len(copied_files_paths)} matched photos to folder: '{user_folder_name}' "
+               f"({copied_count} copied, {kept_count} already present, {removed_count} old ones removed)")
     else:
         msg = f"No photos were copied to '{user_folder_name}' (no matches found or copy errors)."
     # print(msg) # Console log
     return msg, user_specific_dir, copied_files_paths
 
+def create_matched_photos_zip(user_identifier, matched_photos, base_output_dir):
+    """
+    Streams the matched photos straight from their source paths into one ZIP file,
+    so every photo is read once. ZIP_STORED skips deflate: JPEGs are already compressed.
+    Returns (message, zip_path); zip_path is None if nothing could be zipped.
+    """
+    zip_path = os.path.join(base_output_dir, f"matched_photos_{sanitize_foldername(user_identifier)}_{uuid.uuid4().hex[:6]}.zip") # Add uuid to avoid name clashes
+    zipped_count = 0
+    try:
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as zf:
+            for photo_path in matched_photos or []:
+                try:
+                    zf.write(photo_path, arcname=os.path.basename(photo_path))
+                    zipped_count += 1
+                except OSError as e:
+                    print(f"  Error zipping {os.path.basename(photo_path)}: {e}") # Console log
+    except Exception:
+        if os.path.exists(zip_path):
+            os.remove(zip_path)
+        raise
+    if zipped_count == 0:
+        os.remove(zip_path)
+        return "No matched photos could be read to zip.", None
+    return f"{zipped_count} matched photos zipped for download.", zip_path
+
 # --- Main function for Gradio Interface ---
 def process_request_gradio(phone_number, email_address, selfie_pil_image, force_rescan_encodings):
     """
@@ -204,24 +861,37 @@ def process_request_gradio(phone_number, email_address, selfie_pil_image, force_
     
     status_messages.append(f"Inputs Validated: Phone: {phone_number}, Email: {email_address}")
 
-    # 2. Handle Known Encodings (Load or Generate)
-    known_encodings, known_filenames, enc_msg = load_known_encodings(ENCODINGS_FILE_PATH)
-    status_messages.append(f"Encoding Status: {enc_msg}")
-
-    if force_rescan_encodings or known_encodings is None: # known_encodings is None if file not found or error
-        status_messages.append("Force Rescan active or no existing encodings found. Attempting to generate new encodings...")
-        if not os.path.exists(SOURCE_PHOTOS_DIR) or not os.listdir(SOURCE_PHOTOS_DIR):
-            msg = f"ERROR: Source photo directory '{SOURCE_PHOTOS_DIR}' is empty or does not exist. Cannot generate encodings."
-            status_messages.append(msg)
-            if known_encodings is None and not os.path.exists(ENCODINGS_FILE_PATH): # If file truly didn't exist, create an empty one
-                 np.savez_compressed(ENCODINGS_FILE_PATH, encodings=np.array([]), filenames=np.array([]))
-            known_encodings, known_filenames = [], [] # Ensure these are empty lists
-            return "\n".join(status_messages), None, None # Critical error, stop here
-        else:
-            known_encodings, known_filenames, gen_msg = generate_and_save_known_encodings(SOURCE_PHOTOS_DIR, ENCODINGS_FILE_PATH)
-            status_messages.append(f"Encoding Generation: {gen_msg}")
+    # 2. Handle Known Encodings (shared, loaded once; generated on first run or Force Rescan)
+    global KNOWN_ENCODINGS
+    known = KNOWN_ENCODINGS # One read: matrix, scale and filenames always belong together
+    if known is not None and not force_rescan_encodings:
+        # Common case: no lock, so a rescan started by another user does not hold this request up.
+        status_messages.append(f"Encoding Status: Using the {len(known[0])} known face encodings already loaded.")
+    else:
+        with KNOWN_ENCODINGS_LOCK:
+            known = KNOWN_ENCODINGS # Re-check: another request may have loaded or rescanned meanwhile
+            if known is None:
+                enc_msg = _load_once()
+                known = KNOWN_ENCODINGS
+            else:
+                enc_msg = f"Using the {len(known[0])} known face encodings already loaded."
+            status_messages.append(f"Encoding Status: {enc_msg}")
+
+            if force_rescan_encodings or known is None: # known is None if file not found or error
+                status_messages.append("Force Rescan active or no existing encodings found. Attempting to generate new encodings...")
+                if not os.path.exists(SOURCE_PHOTOS_DIR) or next(_iter_source_image_entries(SOURCE_PHOTOS_DIR), None) is None:
+                    msg = f"ERROR: Source photo directory '{SOURCE_PHOTOS_DIR}' has no photos or does not exist. Cannot generate encodings."
+                    status_messages.append(msg)
+                    if known is None and not os.path.exists(ENCODINGS_FILE_PATH + ".json"): # If file truly didn't exist, create an empty one
+                         _save_known_encodings(ENCODINGS_FILE_PATH, [], [])
+                    return "\n".join(status_messages), None, None # Critical error, stop here
+                else:
+                    *known, gen_msg = generate_and_save_known_encodings(SOURCE_PHOTOS_DIR, ENCODINGS_FILE_PATH)
+                    KNOWN_ENCODINGS = known = tuple(known)
+                    status_messages.append(f"Encoding Generation: {gen_msg}")
+    known_encodings, known_scale, known_filenames = known
     
-    if not known_encodings: # Check after attempting load/generate
+    if len(known_encodings) == 0: # Check after attempting load/generate
         # This condition means either source dir was empty, no faces found, or some other error during encoding
         status_messages.append(f"Warning: No face encodings available (source directory '{SOURCE_PHOTOS_DIR}' might be empty, no faces found, or errors occurred). Cannot perform matching.")
         # Don't necessarily exit, as the messages above would indicate the problem.
@@ -237,12 +907,12 @@ def process_request_gradio(phone_number, email_address, selfie_pil_image, force_
     status_messages.append("Selfie processed successfully.")
 
     # 4. Find Matching Photos
-    if not known_encodings: # If still no encodings (e.g., empty source dir from start)
+    if len(known_encodings) == 0: # If still no encodings (e.g., empty source dir from start)
         status_messages.append("No known face encodings to compare against. No matches possible.")
-        matched_photo_paths = []
+        matched_photo_paths, match_distances, results_limited = [], [], False
     else:
         status_messages.append("Searching for your photos using stored encodings...")
-        matched_photo_paths = find_matching_photos(selfie_encoding, known_encodings, known_filenames, SOURCE_PHOTOS_DIR)
+        matched_photo_paths, match_distances, results_limited = find_matching_photos(selfie_encoding, known_encodings, known_scale, known_filenames, SOURCE_PHOTOS_DIR)
 
     if not matched_photo_paths:
         status_messages.append("No matching photos found in the collection for your selfie.")
@@ -251,44 +921,61 @@ def process_request_gradio(phone_number, email_address, selfie_pil_image, force_
         zip_file_output = None
     else:
         status_messages.append(f"Match Found: {len(matched_photo_paths)} photo(s) seem to contain a match.")
+        if results_limited:
+            status_messages.append(f"Note: Results were limited to the {MATCH_TOP_K} closest matching faces; "
+                                   f"more photos of you may exist in the collection.")
 
-        # 5. Create User Folder and Copy Photos
+        # 5. Optionally keep a copy of the matches in the user's own folder
         sanitized_phone = sanitize_foldername(phone_number)
-        copy_msg, user_specific_dir, copied_files_local_paths = create_user_folder_and_copy_photos(
-            sanitized_phone,
-            matched_photo_paths,
-            OUTPUT_BASE_DIR
-        )
-        status_messages.append(f"File Copy: {copy_msg}")
-        gallery_output = copied_files_local_paths # Use the paths of copied files for the gallery
-
-        # 6. Create a ZIP file of the matched photos for download
-        if copied_files_local_paths:
-            try:
-                zip_base_name = os.path.join(OUTPUT_BASE_DIR, f"matched_photos_{sanitized_phone}_{uuid.uuid4().hex[:6]}") # Add uuid to avoid name clashes
-                # Ensure the directory to zip exists and is not empty
-                if os.path.exists(user_specific_dir) and os.listdir(user_specific_dir):
-                    shutil.make_archive(zip_base_name, 'zip', user_specific_dir)
-                    zip_file_output = f"{zip_base_name}.zip"
-                    status_messages.append(f"Download: Matched photos zipped for download.")
-                else:
-                    status_messages.append("Download: No files were available in the user directory to zip.")
-            except Exception as e:
-                status_messages.append(f"Download Error: Could not create ZIP file: {e}")
-                print(f"Error zipping: {e}") # Console log
-        else:
-            status_messages.append("Download: No copied files to zip.")
+        if COPY_MATCHES_TO_USER_FOLDER:
+            copy_msg, _, copied_files_local_paths = create_user_folder_and_copy_photos(
+                sanitized_phone,
+                matched_photo_paths,
+                OUTPUT_BASE_DIR
+            )
+            status_messages.append(f"File Copy: {copy_msg}")
+        # The gallery can show the source photos directly, closest match first
+        gallery_output = [(path, f"Match distance: {distance:.2f} (lower is closer)")
+                          for path, distance in zip(matched_photo_paths, match_distances)]
+
+        # 6. Create a ZIP file of the matched photos for download, read straight from the source photos
+        try:
+            zip_msg, zip_file_output = create_matched_photos_zip(sanitized_phone, matched_photo_paths, OUTPUT_BASE_DIR)
+            status_messages.append(f"Download: {zip_msg}")
+        except Exception as e:
+            status_messages.append(f"Download Error: Could not create ZIP file: {e}")
+            print(f"Error zipping: {e}") # Console log
             
     final_status_message = "\n".join(status_messages)
     return final_status_message, gallery_output, zip_file_output
 
 
+def _warmup():
+    """
+    Pays the one-off costs (dlib detector and encoder forward passes, Numba kernel load, loading the shared
+    encodings and faulting in their pages) at startup instead of in the first user's request.
+    """
+    start_time = time.time()
+    dummy_image = np.random.randint(0, 256, (150, 150, 3), dtype=np.uint8)
+    face_recognition.face_locations(dummy_image, model=SELFIE_DETECTION_MODEL)
+    # Noise contains no face, so pass the whole image as the face location: otherwise face_encodings
+    # finds nothing and returns before the ResNet encoder (and CUDA/cuDNN set-up) ever runs.
+    face_recognition.face_encodings(dummy_image, known_face_locations=[(0, 150, 150, 0)],
+                                    num_jitters=ENCODING_NUM_JITTERS, model=ENCODING_LANDMARK_MODEL)
+    _run_topk(np.zeros((1, ENCODING_DIM), dtype=np.int8), np.zeros(ENCODING_DIM, dtype=np.int16), np.int32(1), MATCH_TOP_K)
+    with KNOWN_ENCODINGS_LOCK:
+        print(_load_once())
+        if KNOWN_ENCODINGS is not None and len(KNOWN_ENCODINGS[0]) > 0:
+            KNOWN_ENCODINGS[0].sum(dtype=np.int64) # Touch every page of the memory-mapped matrix
+    print(f"Warm-up completed in {time.time() - start_time:.2f} seconds.")
+
+
 # --- Define Gradio Interface ---
 inputs = [
     gr.Textbox(label="Your 10-digit Phone Number", placeholder="e.g., 1234567890", info="Used for organizing your photos."),
     gr.Textbox(label="Your Email Address", placeholder="e.g., user@example.com", info="Please provide your email."),
     gr.Image(type="pil", label="Upload or Capture Your Selfie", sources=["upload", "webcam"], height=400),
-    gr.Checkbox(label="Force Rescan of Source Photo Encodings", info="Check this if new event photos have been added or if this is the very first run. This process can be slow depending on the number of source photos.")
+    gr.Checkbox(label="Force Rescan of Source Photo Encodings", info="Check this if new event photos have been added or if this is the very first run. Only new or changed photos are encoded, so only the first scan is slow.")
 ]
 
 outputs = [
@@ -306,7 +993,8 @@ description = (
     "**Important Note for Admins/First Use:** If new event photos have been added to the system's `all_photos` folder, "
     "or if this is the first time running the service with a new set of event photos, "
     "please check the **'Force Rescan of Source Photo Encodings'** box. This initial scan and encoding process "
-    "can take several minutes depending on the number of photos. Subsequent runs (without 'Force Rescan') will be much faster."
+    "can take several minutes depending on the number of photos. Subsequent runs (without 'Force Rescan') will be much faster, "
+    "and later rescans only encode photos that were added or changed since the last scan."
 )
 
 article = (
@@ -334,10 +1022,13 @@ if __name__ == "__main__":
     print(f"Source photos are expected in: '{os.path.abspath(SOURCE_PHOTOS_DIR)}'")
     print(f"User selfies (if saved from upload, though Gradio handles temp files) would be in: '{os.path.abspath(USER_SELFIE_STORAGE_DIR)}'")
     print(f"Sorted photos and ZIP files will be saved in subdirectories of: '{os.path.abspath(OUTPUT_BASE_DIR)}'")
-    print(f"Pre-computed encodings file: '{os.path.abspath(ENCODINGS_FILE_PATH)}'")
+    print(f"Pre-computed encodings file: '{os.path.abspath(ENCODINGS_FILE_PATH)}.json'")
+    print(f"dlib built with CUDA: {bool(dlib.DLIB_USE_CUDA)}; using GPU: {USE_CUDA} (selfie detector: '{SELFIE_DETECTION_MODEL}')")
     print("-------------------------")
+    _warmup()
     print("\nLaunching Gradio app... Access it locally via the URL printed below (usually http://127.0.0.1:7860 or similar).")
     
     # To make it accessible on your local network: iface.launch(server_name="0.0.0.0")
     # To create a temporary public link (expires in 72 hours): iface.launch(share=True)
+    iface.queue(default_concurrency_limit=GRADIO_CONCURRENCY_LIMIT)
     iface.launch(share=True)